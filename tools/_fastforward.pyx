@@ -0,0 +1,88 @@
+# cython: language_level=3
+"""Clips - Socket to socket forwarding loop in C.
+
+    Clipboard Server Project
+    Copyright (C) 2019  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Optional, build it next to server.py with:
+    cythonize -i _fastforward.pyx
+"""
+
+import os
+
+from libc.errno cimport errno, EAGAIN, EINTR
+
+
+cdef extern from "<errno.h>":
+    int EWOULDBLOCK
+
+
+cdef extern from "<sys/socket.h>" nogil:
+    ssize_t recv(int fd, void *buf, size_t n, int flags)
+    ssize_t send(int fd, const void *buf, size_t n, int flags)
+
+
+cdef extern from *:
+    """
+    #ifndef MSG_NOSIGNAL
+    #define MSG_NOSIGNAL 0
+    #endif
+    """
+    int MSG_NOSIGNAL
+
+
+def forward_pair(int fd_a, int fd_b, unsigned char[::1] buf not None):
+    """Forward data from fd_a to fd_b until one of them would block.
+
+    Both sockets must be non-blocking. Return (size, sent) for the last
+    chunk read into buf: size is -1 if fd_a would block and 0 on EOF.
+    If sent < size, buf[sent:size] still has to be sent to fd_b.
+    """
+    cdef char *data = <char *>&buf[0]
+    cdef size_t capacity = buf.shape[0]
+    cdef ssize_t size = 0
+    cdef ssize_t sent = 0
+    cdef ssize_t n
+    cdef int error = 0
+
+    with nogil:
+        while True:
+            sent = 0
+            size = recv(fd_a, data, capacity, 0)
+            if size < 0:
+                if errno == EINTR:
+                    continue
+                if errno != EAGAIN and errno != EWOULDBLOCK:
+                    error = errno
+                size = -1
+                break
+            if size == 0:
+                break
+            while sent < size:
+                n = send(fd_b, data + sent, size - sent, MSG_NOSIGNAL)
+                if n < 0:
+                    if errno == EINTR:
+                        continue
+                    if errno != EAGAIN and errno != EWOULDBLOCK:
+                        error = errno
+                    break
+                sent += n
+            if error or sent < size:
+                break
+
+    if error:
+        raise OSError(error, os.strerror(error))
+    return size, sent
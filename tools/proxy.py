@@ -19,30 +19,107 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import base64
+import logging
 import socket
+import struct
 import sys
 import traceback
 import threading
 
-from contextlib import closing
-from select import select
+from collections import deque
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
 
 try:
-    from Queue import Queue
+    from pybase64 import b64decode, b64encode
 except ImportError:
-    from queue import Queue
+    from base64 import b64decode, b64encode
+
+logger = logging.getLogger(__name__)
+
+BASE64_MARKER = b"$BASE64$"
+BINARY_MARKER = b"$BINARY$"
+FRAME_HEADER = struct.Struct("!BI")  # Version, body length
+FRAME_VERSION = 2
+SOCKET_BUFFER_SIZE = 256 * 1024
+
+
+def tune_socket(sock, buffer_size=SOCKET_BUFFER_SIZE):
+    """Send small frames right away and enlarge the kernel buffers."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+
+
+def read_frame_body(f, line):
+    """Return the body of the $BINARY$ frame starting on line.
+
+    The body can contain newlines, so what readline() stopped at is
+    completed with exact reads. Frames end with a newline which keeps
+    readline() from reading past them.
+    """
+    frame = line[len(BINARY_MARKER):]
+    size = FRAME_HEADER.size
+    if len(frame) < size:
+        frame += f.read(size - len(frame))
+    version, length = FRAME_HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version {}".format(version))
+    missing = size + length + 1 - len(frame)
+    if missing > 0:
+        frame += f.read(missing)
+    return frame[size:size + length]
+
+
+class FrameReader(object):
+    """Read newline-terminated frames straight from a socket."""
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.size = size
+        self.buf = bytearray()
+
+    def _fill(self):
+        chunk = self.sock.recv(self.size)
+        self.buf += chunk
+        return len(chunk)
+
+    def readline(self):
+        """Return the next line, or what is left when the peer is gone."""
+        i = self.buf.find(b"\n")
+        while i < 0:
+            start = len(self.buf)
+            if not self._fill():
+                i = start - 1
+                break
+            i = self.buf.find(b"\n", start)
+        line = bytes(self.buf[:i + 1])
+        del self.buf[:i + 1]
+        return line
+
+    def read(self, size):
+        """Return size bytes, fewer only when the peer is gone."""
+        while len(self.buf) < size:
+            if not self._fill():
+                break
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def close(self):
+        self.sock.close()
 
 
 class BaseHandler(object):
     """Basic spawn handler."""
-    BUFFER_SIZE = 1024
 
     def __init__(self, clipin, clipout):
         self.rconn = socket.create_connection(clipout)
-        self.rfile = self.rconn.makefile()
+        tune_socket(self.rconn)
+        self.rfile = FrameReader(self.rconn)
         self.wconn = socket.create_connection(clipin)
-        self.wfile = self.wconn.makefile()
+        tune_socket(self.wconn)
+        self.wfile = self.wconn.makefile("wb")
 
     def __enter__(self):
         self.start()
@@ -80,94 +157,239 @@ class BaseHandler(object):
         return self._write(self.wfile, data)
 
 
+class ProxySession(object):
+    """Connection opened on behalf of a server session."""
+
+    def __init__(self, session_id, address, port):
+        self.session_id = session_id
+        self.address = address
+        self.port = port
+        self.session_tag = session_id.encode() + b"$"
+        self.pending = deque()  # Data to send, filled by the reader
+        self.socket = None
+        self.result = None
+        self.events = 0
+        self.closed = False
+
+
 class SOCKSHandler(BaseHandler):
+    # Send data as raw $BINARY$ frames instead of $BASE64$ lines, this
+    # requires an 8-bit clean clipboard channel
+    BINARY_FRAMES = False
+    # The server's stdin is a canonical tty which keeps at most 4095
+    # characters per line, 3000 bytes make a 4000 characters $BASE64$ line
+    FRAME_DATA_SIZE = 3000
+    WAKEUP_SIZE = 4096  # Wakeup bytes drained per reactor iteration
+    BURST_SIZE = 64 * 1024
+
     def __init__(self, *args, **kwargs):
         BaseHandler.__init__(self, *args, **kwargs)
         self._sessions = {}
+        self._rxview = memoryview(bytearray(self.BURST_SIZE))
+        self._ready = deque()  # Sessions the reactor has to update
+        self._selector = DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, EVENT_READ)
+        self._reactor_thread = threading.Thread(target=self._reactor)
+        self._reactor_thread.daemon = True
+        self._reactor_thread.start()
 
     def read(self):
         while True:
             line = self._read(self.rfile)
-            sys.stderr.write(":{}\n".format(line.strip()))
-            head, sep, tail = line.partition("$BASE64$")
+            logger.debug(":%s", line.rstrip())
             # Not a command
-            if head:
+            if not line.startswith((BASE64_MARKER, BINARY_MARKER)):
                 return line
-            # Handle $BASE64$ command
-            session_id, sep, tail = tail.partition("$")
             try:
-                # Handle CONNECT
-                if "$" in tail[:1]:
-                    _, port, address = tail.split('$')
-                    address = address.strip()
-                    port = int(port)
-                    self.spawn_worker(session_id, address, port)
-                    continue
-                # Handle SESSION data
-                data = base64.b64decode(tail)
-                self._sessions[session_id][2].put(data)
+                self._handle_command(line)
             except:
                 sys.stderr.write(traceback.format_exc().replace("\n", "\r\n"))
                 sys.stderr.flush()
 
+    def _handle_command(self, line):
+        # Handle $BINARY$ command
+        if line.startswith(BINARY_MARKER):
+            body = read_frame_body(self.rfile, line)
+            session_id, sep, data = body.partition(b"$")
+            return self._post(session_id.decode("ascii"), data)
+        # Handle $BASE64$ command
+        session_id, sep, tail = line[len(BASE64_MARKER):].partition(b"$")
+        session_id = session_id.decode("ascii")
+        # Handle CONNECT
+        if tail.startswith(b"$"):
+            sep = tail.find(b"$", 1)
+            port = int(tail[1:sep])
+            address = tail[sep + 1:].rstrip().decode()
+            return self.spawn_worker(session_id, address, port)
+        # Handle SESSION data
+        self._post(session_id, b64decode(tail.rstrip(), validate=False))
+
     def spawn_worker(self, session_id, address, port):
-        self._sessions[session_id] = (address, port, Queue())
-        t = threading.Thread(target=self._worker, args=(session_id,))
+        session = ProxySession(session_id, address, port)
+        self._sessions[session_id] = session
+        # Name resolution and connect() block, keep them off the reactor
+        t = threading.Thread(target=self._connect, args=(session,))
         t.daemon = True
         t.start()
         sys.stderr.write("[PROXY] CONNECT {}:{} ({})\r\n".format(
             address, port, session_id
         ))
 
+    def _connect(self, session):
+        proxy_socket = None
+        try:
+            proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tune_socket(proxy_socket)
+            result = proxy_socket.connect_ex((session.address, session.port))
+            proxy_socket.setblocking(False)
+        except OSError as e:  # Out of sockets or name resolution failed
+            result = e.errno or -1
+        session.socket = proxy_socket
+        session.result = result  # Set last, the reactor waits for it
+        self._schedule(session)
+
+    def _post(self, session_id, data):
+        """Queue data for the session and wake the reactor up."""
+        session = self._sessions[session_id]
+        session.pending.append(data)
+        self._schedule(session)
+
+    def _schedule(self, session):
+        self._ready.append(session)
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass  # The reactor has pending wakeups already
 
-    def _send(self, session_id, data):
-        data = "$BASE64${}${}\n".format(session_id, base64.b64encode(data))
-        sys.stderr.write("!{}".format(data))
-        return self.wconn.sendall(
-            data
+    def _frame(self, session_tag, data):
+        if self.BINARY_FRAMES:
+            return (
+                BINARY_MARKER +
+                FRAME_HEADER.pack(
+                    FRAME_VERSION, len(session_tag) + len(data)
+                ) +
+                session_tag + data + b"\n"
+            )
+        return BASE64_MARKER + session_tag + b64encode(data) + b"\n"
+
+    def _send(self, session_tag, data):
+        """Send data split in frames the server's terminal can take."""
+        size = self.FRAME_DATA_SIZE
+        data = b"".join(
+            self._frame(session_tag, data[i:i + size])
+            for i in range(0, max(len(data), 1), size)
         )
+        logger.debug("!%s", data)
+        return self.wconn.sendall(data)
+
+    def _reactor(self):
+        """Relay data of every session from a single thread."""
+        while True:
+            for key, events in self._selector.select():
+                session = key.data
+                if session is None:
+                    self._wakeup_r.recv(self.WAKEUP_SIZE)
+                    while self._ready:
+                        self._update(self._ready.popleft())
+                    continue
+                if not session.events:
+                    continue  # Closed earlier in this iteration
+                if events & EVENT_READ:
+                    self._receive(session)
+                if events & EVENT_WRITE and session.events:
+                    self._flush(session)
+
+    def _update(self, session):
+        """Handle a new connection result or new pending data."""
+        if session.result is None or session.closed:
+            return  # Still connecting or already closed
+        if not session.events:
+            self._send(session.session_tag, str(session.result).encode())
+            if session.result != 0:
+                return self._close(session)
+            session.events = EVENT_READ
+            self._selector.register(session.socket, EVENT_READ, session)
+        self._flush(session)
+
+    def _recv_burst(self, sock):
+        """Read everything already available on sock, up to BURST_SIZE.
+
+        The returned view is only valid until the next read.
+        """
+        view = self._rxview
+        size = sock.recv_into(view)
+        while size and size < self.BURST_SIZE:
+            try:
+                chunk_size = sock.recv_into(view[size:])
+            except BlockingIOError:
+                break
+            if not chunk_size:
+                break
+            size += chunk_size
+        return view[:size]
+
+    def _receive(self, session):
+        try:
+            data = self._recv_burst(session.socket)
+        except BlockingIOError:
+            return
+        except IOError:
+            sys.stderr.write("[PROXY] IOError {}\n".format(session.session_id))
+            return self._close(session)
+        self._send(session.session_tag, data)
+        if not data:
+            sys.stderr.write("[PROXY] EMPTY RESPONSE ({})\n".format(session.session_id))
+            return self._close(session)
+        logger.debug(
+            "[PROXY] RESPONSE data to %s [len=%d]",
+            session.session_id, len(data)
+        )
+
+    def _flush(self, session):
+        """Send pending data, wait for EVENT_WRITE if the socket is full."""
+        pending = session.pending
+        while pending:
+            data = pending[0]
+            if not data:
+                sys.stderr.write("[PROXY] EMPTY REQUEST ({})\n".format(session.session_id))
+                return self._close(session)
+            try:
+                size = session.socket.send(data)
+            except BlockingIOError:
+                break
+            except IOError:
+                sys.stderr.write("[PROXY] IOError {}\n".format(session.session_id))
+                return self._close(session)
+            logger.debug(
+                "[PROXY] REQUEST data to %s [len=%d]",
+                session.session_id, size
+            )
+            if size < len(data):
+                pending[0] = memoryview(data)[size:]
+                break
+            pending.popleft()
+        events = EVENT_READ | EVENT_WRITE if pending else EVENT_READ
+        if events != session.events:
+            session.events = events
+            self._selector.modify(session.socket, events, session)
 
-    def _worker(self, session_id):
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as proxy_socket:
-            result = proxy_socket.connect_ex(self._sessions[session_id][:2])
-            self._send(session_id, str(result))
-            if result != 0:
-                return
-            is_alive = True
-            while is_alive:
-                rlist, wlist, xlist = select([proxy_socket], [], [], 0.5)
-                for fd in rlist:
-                    try:
-                        data = fd.recv(self.BUFFER_SIZE)
-                        self._send(session_id, data)
-                        if not data:
-                            sys.stderr.write("[PROXY] EMPTY RESPONSE ({})\n".format(session_id))
-                            del self._sessions[session_id]
-                            is_alive = False
-                        else:
-                            sys.stderr.write("[PROXY] RESPONSE data to {} [len={}]\n".format(
-                                session_id, len(data)
-                            ))
-                    except IOError:
-                        sys.stderr.write("[PROXY] IOError {}\n".format(session_id))
-                        is_alive = False
-                while is_alive and not self._sessions[session_id][2].empty():
-                    data = self._sessions[session_id][2].get_nowait()
-                    if data:
-                        proxy_socket.sendall(data)
-                        sys.stderr.write("[PROXY] REQUEST data to {} [len={}]\n".format(
-                            session_id, len(data)
-                        ))
-                    else:
-                        is_alive = False
-                        sys.stderr.write("[PROXY] EMPTY REQUEST ({})\n".format(session_id))
-                    sys.stderr.flush()
-            sys.stderr.write("[PROXY] CLOSE {}\n".format(session_id))
+    def _close(self, session):
+        self._sessions.pop(session.session_id, None)
+        if session.events:
+            self._selector.unregister(session.socket)
+            session.events = 0
+        if session.socket is not None:
+            session.socket.close()
+        session.closed = True
+        sys.stderr.write("[PROXY] CLOSE {}\n".format(session.session_id))
 
 
 if __name__ == "__main__":
     CLIPIN = ("127.0.0.1", 21000)
     CLIPOUT = ("127.0.0.1", 21001)
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
 
     with SOCKSHandler(CLIPIN, CLIPOUT) as h:
         data = h.read()
@@ -19,23 +19,86 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import base64
-import random
-import string
+import asyncio
+import errno
+import os
 import struct
 import sys
 import traceback
 
 from contextlib import closing
-from select import select
-from socket import inet_ntoa, socket, create_connection, AF_INET, SOCK_STREAM
+from queue import Empty, SimpleQueue
+from secrets import token_urlsafe
+from socket import inet_ntoa, socket, AF_INET, SOCK_STREAM
+from socket import IPPROTO_TCP, SOL_SOCKET, TCP_NODELAY
+from socket import SO_KEEPALIVE, SO_RCVBUF, SO_REUSEADDR, SO_SNDBUF
 
 try:
-    from Queue import Queue
-    from SocketServer import ThreadingTCPServer, StreamRequestHandler
+    from pybase64 import b64decode, b64encode
 except ImportError:
-    from queue import Queue
-    from socketserver import ThreadingTCPServer, StreamRequestHandler
+    from base64 import b64decode, b64encode
+
+try:
+    from _fastforward import forward_pair
+except ImportError:
+    forward_pair = None
+
+BASE64_MARKER = b"$BASE64$"
+BINARY_MARKER = b"$BINARY$"
+FRAME_HEADER = struct.Struct("!BI")  # Version, body length
+FRAME_VERSION = 2
+SOCKET_BUFFER_SIZE = 256 * 1024
+
+
+def read_frame_body(f, line):
+    """Return the body of the $BINARY$ frame starting on line.
+
+    The body can contain newlines, so what readline() stopped at is
+    completed with exact reads. Frames end with a newline which keeps
+    readline() from reading past them.
+    """
+    frame = line[len(BINARY_MARKER):]
+    size = FRAME_HEADER.size
+    if len(frame) < size:
+        frame += f.read(size - len(frame))
+    version, length = FRAME_HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version {}".format(version))
+    missing = size + length + 1 - len(frame)
+    if missing > 0:
+        frame += f.read(missing)
+    return frame[size:size + length]
+
+
+def tune_socket(sock, buffer_size=SOCKET_BUFFER_SIZE):
+    """Send small frames right away and enlarge the kernel buffers."""
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, buffer_size)
+    sock.setsockopt(SOL_SOCKET, SO_SNDBUF, buffer_size)
+
+
+def wait_readable(loop, sock):
+    """Return a future done once sock is readable."""
+    return _wait_ready(loop, loop.add_reader, loop.remove_reader, sock)
+
+
+def wait_writable(loop, sock):
+    """Return a future done once sock is writable."""
+    return _wait_ready(loop, loop.add_writer, loop.remove_writer, sock)
+
+
+def _wait_ready(loop, add, remove, sock):
+    fd = sock.fileno()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    add(fd, ready)
+    future.add_done_callback(lambda _: remove(fd))
+    return future
 
 
 class SocksMethod(object):
@@ -69,66 +132,135 @@ class ReplyType(object):
     ADDRESS_TYPE_NOT_SUPPORTED = 8
 
 
-class Socks5RequestHandler(StreamRequestHandler):
+class Socks5RequestHandler(object):
     SOCKS_VERSION = 5
 
-    def recv(self, size):
-        return self.rfile.read(size)
-
-    def send(self, data):
-        return self.wfile.write(data)
-
-    def handle(self):
+    def __init__(self, connection, server):
+        self.connection = connection
+        self.server = server
+        self.loop = server.loop
+
+    async def recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = await self.loop.sock_recv(
+                self.connection, size - len(data)
+            )
+            if not chunk:
+                raise EOFError("Connection closed by the client")
+            data += chunk
+        return data
+
+    async def send(self, data):
+        return await self.loop.sock_sendall(self.connection, data)
+
+    async def handle(self):
         # Methods handling
-        version, method_num = struct.unpack('bb', self.recv(2))
-        methods = struct.unpack('b' * method_num, self.recv(method_num))
+        greeting = await self.recv(2)
+        methods = await self.recv(greeting[1])
         if SocksMethod.NO_AUTHENTICATION_REQUIRED in methods:
-            self.send(bytearray([
+            await self.send(bytearray([
                 self.SOCKS_VERSION,
                 SocksMethod.NO_AUTHENTICATION_REQUIRED
             ]))
         else:
-            self.send(bytearray([
+            await self.send(bytearray([
                 self.SOCKS_VERSION,
                 SocksMethod.NO_ACCEPTABLE_METHODS
             ]))
             return
 
         # Address handling
-        version, command, reserved, address_type = struct.unpack('bbbb', self.recv(4))
+        # VER, CMD, RSV, ATYP and the first address byte in one read
+        request = await self.recv(5)
+        command, address_type = request[1], request[3]
         if address_type == AddressType.IPV4:
-            host = inet_ntoa(self.recv(4))
-            port = struct.unpack("!H", self.recv(2))[0]
+            request = memoryview(request + await self.recv(5))
+            host = inet_ntoa(request[4:8])
+            port = int.from_bytes(request[8:10], "big")
         elif address_type == AddressType.DOMAIN_NAME:
-            host = self.recv(struct.unpack('b', self.recv(1))[0])
-            port = struct.unpack("!H", self.recv(2))[0]
+            length = request[4]
+            request = memoryview(await self.recv(length + 2))
+            host = bytes(request[:length]).decode()
+            port = int.from_bytes(request[length:], "big")
         else:
-            host, port = None, None
-            self.send_response(ReplyType.ADDRESS_TYPE_NOT_SUPPORTED)
+            return await self.send_response(
+                ReplyType.ADDRESS_TYPE_NOT_SUPPORTED
+            )
 
         # Command handling
         address = host, port
         if command == SocksCommand.CONNECT:
-            session = self.server.session_manager.create_session()
-            session.connect(self, address)
-            session.close()
+            session_manager = self.server.session_manager
+            session = session_manager.create_session()
+            try:
+                await session.connect(self, address)
+            finally:
+                session_manager.close_session(session.get_id())
         else:
-            self.send_response(ReplyType.COMMAND_NOT_SUPPORTED)
+            await self.send_response(ReplyType.COMMAND_NOT_SUPPORTED)
 
-    def send_response(self, reply_type):
+    async def send_response(self, reply_type):
         response = bytearray(10)
         response[0] = self.SOCKS_VERSION
         response[1] = reply_type
         response[3] = 1
-        return self.send(response)
+        return await self.send(response)
+
+
+class Socks5Server(object):
+    """SOCKS5 server running one asyncio task per client."""
+    allow_reuse_address = True
+    request_queue_size = 128
+    ACCEPT_RETRY_DELAY = 0.1  # Out of file descriptors, let sessions end
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.loop = None
+        self._tasks = set()
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        with closing(socket(AF_INET, SOCK_STREAM)) as listener:
+            if self.allow_reuse_address:
+                listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            tune_socket(listener)  # Buffer sizes are set before accept()
+            listener.bind(self.server_address)
+            listener.listen(self.request_queue_size)
+            listener.setblocking(False)
+            while True:
+                try:
+                    connection, _ = await self.loop.sock_accept(listener)
+                except OSError as e:
+                    sys.stderr.write(
+                        "[SERVER] accept() failed: {}\n".format(e)
+                    )
+                    sys.stderr.flush()
+                    if e.errno in (errno.EMFILE, errno.ENFILE):
+                        await asyncio.sleep(self.ACCEPT_RETRY_DELAY)
+                    continue
+                connection.setblocking(False)
+                tune_socket(connection)
+                task = self.loop.create_task(self._handle(connection))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, connection):
+        with closing(connection):
+            try:
+                await self.RequestHandlerClass(connection, self).handle()
+            except Exception:
+                traceback.print_exc()
 
 
 class Session(object):
-    BUFFER_SIZE = 1024
+    BUFFER_SIZE = 32 * 1024
 
     def __init__(self, session_id):
         self._session_id = session_id
         self._is_alive = True
+        self._tasks = []
 
     def get_id(self):
         return self._session_id
@@ -136,80 +268,207 @@ class Session(object):
     def is_alive(self):
         return self._is_alive
 
-    def connect(self, handler, address):
+    async def _run(self, *coroutines):
+        """Run coroutines until one of them ends or the session closes."""
+        self._tasks = [asyncio.ensure_future(c) for c in coroutines]
+        try:
+            done, _ = await asyncio.wait(
+                self._tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.wait(self._tasks)
+        for task in done:
+            if not task.cancelled():
+                task.result()  # Propagate errors
+
+    async def _splice(self, loop, src, dst, pipe):
+        """Move available data from src to dst through pipe.
+
+        Return its size, or None if src can't be spliced.
+        """
+        pipe_r, pipe_w = pipe
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        while True:
+            try:
+                size = os.splice(
+                    src.fileno(), pipe_w, self.BUFFER_SIZE, flags=flags
+                )
+                break
+            except BlockingIOError:
+                await wait_readable(loop, src)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                return None
+        pending = size
+        while pending:
+            try:
+                pending -= os.splice(
+                    pipe_r, dst.fileno(), pending, flags=flags
+                )
+            except BlockingIOError:
+                await wait_writable(loop, dst)
+        return size
+
+    async def _forward_pair(self, loop, src, dst, view):
+        """Forward data with the _fastforward C loop.
+
+        Return the size of the last chunk read, 0 on EOF.
+        """
+        while True:
+            size, sent = forward_pair(src.fileno(), dst.fileno(), view)
+            if size >= 0:
+                break
+            await wait_readable(loop, src)
+        if sent < size:
+            await loop.sock_sendall(dst, view[sent:size])
+        return size
+
+    async def _forward(self, loop, src, dst):
+        """Forward data from src to dst until either side is closed."""
+        pipe = os.pipe() if hasattr(os, "splice") else None
+        view = None
+        try:
+            while self.is_alive():
+                size = None
+                if pipe is not None:
+                    size = await self._splice(loop, src, dst, pipe)
+                    if size is None:  # Not spliceable, use recv/sendall
+                        os.close(pipe[0])
+                        os.close(pipe[1])
+                        pipe = None
+                if size is None and view is None:
+                    view = memoryview(bytearray(self.BUFFER_SIZE))
+                if size is None and forward_pair is not None:
+                    size = await self._forward_pair(loop, src, dst, view)
+                if size is None:
+                    size = await loop.sock_recv_into(src, view)
+                    await loop.sock_sendall(dst, view[:size])
+                if not size:
+                    break
+        except IOError:
+            pass
+        finally:
+            if pipe is not None:
+                os.close(pipe[0])
+                os.close(pipe[1])
+            self.close()
+
+    async def connect(self, handler, address):
         print("[ID:{}] TCP CONNECT {}:{}".format(self.get_id(), *address))
+        loop = handler.loop
         with closing(socket(AF_INET, SOCK_STREAM)) as proxy_socket:
-            result = proxy_socket.connect_ex(address)
+            proxy_socket.setblocking(False)
+            tune_socket(proxy_socket)
+            try:
+                await loop.sock_connect(proxy_socket, address)
+                result = 0
+            except OSError as e:
+                result = e.errno
             if result == 0:
-                handler.send_response(ReplyType.SUCCEEDED)
-                fd_list = [handler.connection, proxy_socket]
-                while self.is_alive():
-                    rlist, wlist, xlist = select(fd_list, [], [], 0.5)
-                    for fd in rlist:
-                        try:
-                            data = fd.recv(self.BUFFER_SIZE)
-                            if not data:
-                                self.close()
-                                break
-                            dest = fd_list[(fd_list.index(fd) + 1) % 2]
-                            dest.sendall(data)
-                        except IOError:
-                            self.close()
+                await handler.send_response(ReplyType.SUCCEEDED)
+                await self._run(
+                    self._forward(loop, handler.connection, proxy_socket),
+                    self._forward(loop, proxy_socket, handler.connection)
+                )
             elif result == 60:
-                handler.send_response(ReplyType.TTL_EXPIRED)
+                await handler.send_response(ReplyType.TTL_EXPIRED)
             elif result == 61:
-                handler.send_response(ReplyType.NETWORK_UNREACHABLE)
+                await handler.send_response(ReplyType.NETWORK_UNREACHABLE)
             else:
-                handler.send_response(ReplyType.NETWORK_UNREACHABLE)
+                await handler.send_response(ReplyType.NETWORK_UNREACHABLE)
+
+    def _stop(self):
+        self._is_alive = False
+        for task in self._tasks:
+            task.cancel()
 
     def close(self):
         print("[ID:{}] SESSION CLOSE".format(self.get_id()))
-        self._is_alive = False
+        self._stop()
 
 
 class ClipsSession(Session):
-    def connect(self, handler, address):
-        self.handler = handler
-        self.proxy_socket = None
-        fd_list = [handler.connection]
-        message = b"$BASE64${}$${}${}\n".format(
-            self.get_id(), address[1], address[0]
-        )
-        handler.server._mq.put(message)
+    # Send data as raw $BINARY$ frames instead of $BASE64$ lines, this
+    # requires an 8-bit clean terminal
+    BINARY_FRAMES = False
+    BURST_SIZE = 64 * 1024
+
+    def __init__(self, session_id):
+        Session.__init__(self, session_id)
+        self._session_tag = session_id.encode() + b"$"
+        self._frame_prefix = BASE64_MARKER + self._session_tag
+        self._rxview = memoryview(bytearray(self.BURST_SIZE))
+
+    async def _recv_burst(self, loop, sock):
+        """Read everything already available on sock, up to BURST_SIZE.
+
+        The returned view is only valid until the next read.
+        """
+        view = self._rxview
+        size = await loop.sock_recv_into(sock, view)
+        while size and size < self.BURST_SIZE:
+            try:
+                chunk_size = sock.recv_into(view[size:])
+            except BlockingIOError:
+                break
+            if not chunk_size:
+                break
+            size += chunk_size
+        return view[:size]
+
+    def _frame(self, data):
+        """Wrap data received from the client for the proxy."""
+        if self.BINARY_FRAMES:
+            return (
+                BINARY_MARKER +
+                FRAME_HEADER.pack(
+                    FRAME_VERSION, len(self._session_tag) + len(data)
+                ) +
+                self._session_tag + data + b"\n"
+            )
+        return self._frame_prefix + b64encode(data) + b"\n"
+
+    async def _forward_client(self, handler):
+        """Send what the client writes to the proxy."""
         while self.is_alive():
-            rlist, wlist, xlist = select(fd_list, [], [], 0.5)
-            for fd in rlist:
-                try:
-                    data = fd.recv(self.BUFFER_SIZE)
-                    message = b"$BASE64${}${}\n".format(
-                        self.get_id(), base64.b64encode(data)
-                    )
-                    handler.server._mq.put(message)
-                    if not data:
-                        self.close()
-                except IOError:
+            try:
+                data = await self._recv_burst(handler.loop, handler.connection)
+                handler.server._mq.put(self._frame(data))
+                if not data:
                     self.close()
+            except IOError:
+                self.close()
+
+    async def connect(self, handler, address):
+        self.handler = handler
+        self.proxy_socket = None
+        handler.server._mq.put(b"$".join((
+            self._frame_prefix, b"%d" % address[1], address[0].encode() + b"\n"
+        )))
+        await self._run(self._forward_client(handler))
 
-    def get_response(self, data):
+    async def get_response(self, data):
         """Send data to the client."""
         if not data:
             return self.close()
         if self.proxy_socket is not None:
-            return self.handler.connection.sendall(data)
+            return await self.handler.send(data)
         self.proxy_socket = int(bytearray(data).decode())
         if self.proxy_socket == 0:
-            return self.handler.send_response(ReplyType.SUCCEEDED)
-        self.handler.send_response(ReplyType.NETWORK_UNREACHABLE)
+            return await self.handler.send_response(ReplyType.SUCCEEDED)
+        await self.handler.send_response(ReplyType.NETWORK_UNREACHABLE)
         return self.close()
 
 
     def close(self):
-        self._is_alive = False
+        self._stop()
 
 
 class SessionManager(object):
-    ID_CHARSET = string.letters + string.digits
-    ID_SIZE = 8
+    ID_BYTES = 6  # 8 URL-safe base64 characters
     SESSION_CLASS = Session
 
     def __init__(self, server):
@@ -218,16 +477,7 @@ class SessionManager(object):
         self._server.session_manager = self
 
     def _create_session_id(self):
-        session_id = "".join([
-            random.choice(self.ID_CHARSET)
-            for _ in range(self.ID_SIZE)
-        ])
-        while session_id in self._sessions:
-            session_id = "".join([
-                random.choice(self.ID_CHARSET)
-                for _ in range(self.ID_SIZE)
-            ])
-        return session_id
+        return token_urlsafe(self.ID_BYTES)
 
     def create_session(self):
         session_id = self._create_session_id()
@@ -250,12 +500,13 @@ class SessionManager(object):
 
 class ClipsSessionManager(SessionManager):
     SESSION_CLASS = ClipsSession
+    STDOUT_BATCH_SIZE = 256 * 1024
 
     def __init__(self, server):
         import threading
 
         SessionManager.__init__(self, server)
-        self._server._mq = Queue()
+        self._server._mq = SimpleQueue()
 
         # Monitor STDIN/STDOUT
         self._stdin_worker_thread = threading.Thread(
@@ -269,27 +520,41 @@ class ClipsSessionManager(SessionManager):
         self._stdin_worker_thread.start()
         self._stdout_worker_thread.start()
 
+    def _respond(self, session, data):
+        """Run session.get_response() on the server loop and wait for it."""
+        asyncio.run_coroutine_threadsafe(
+            session.get_response(data), self._server.loop
+        ).result()
+
     def _stdin_worker(self):
         """Listen decode STDIN.
 
         Base64 encoded format:
         $BASE64$<SESSION_ID>$<B64_DATA>
+
+        Binary format (version 2):
+        $BINARY$<VERSION:1><LENGTH:4><SESSION_ID>$<DATA>
         """
-        line = sys.stdin.readline()
+        stdin = sys.stdin.buffer
+        line = stdin.readline()
         while line:
-            line = line.strip()
-            if line:
-                head, sep, tail = line.partition("$BASE64$")
-                if not head:
-                    session_id, sep, data = tail.partition("$")
-                    try:
-                        data = base64.b64decode(data)
-                        session = self.get_session(session_id)
-                        session.get_response(data)
-                    except:
-                        sys.stderr.write(traceback.format_exc())
-                        sys.stderr.flush()
-            line = sys.stdin.readline()
+            try:
+                if line.startswith(BINARY_MARKER):
+                    body = read_frame_body(stdin, line)
+                    sep = body.index(b"$")
+                    session = self.get_session(body[:sep].decode("ascii"))
+                    self._respond(session, body[sep + 1:])
+                elif line.startswith(BASE64_MARKER):
+                    start = len(BASE64_MARKER)
+                    sep = line.index(b"$", start)
+                    session = self.get_session(line[start:sep].decode("ascii"))
+                    self._respond(session, b64decode(
+                        line[sep + 1:].rstrip(), validate=False
+                    ))
+            except:
+                sys.stderr.write(traceback.format_exc())
+                sys.stderr.flush()
+            line = stdin.readline()
 
 
     def _stdout_worker(self):
@@ -298,13 +563,23 @@ class ClipsSessionManager(SessionManager):
         Base64 encoded format:
         $BASE64$<SESSION_ID>$<B64_DATA>
 
+        Binary format (version 2, see ClipsSession.BINARY_FRAMES):
+        $BINARY$<VERSION:1><LENGTH:4><SESSION_ID>$<DATA>
+
         Base64 encoded format (on connect):
         $BASE64$<SESSION_ID>$$<PORT>$<ADDRESS>
         """
+        mq = self._server._mq
+        stdout = sys.stdout.buffer
         while True:
-            data = self._server._mq.get()
-            sys.stdout.write(data)
-            sys.stdout.flush()
+            data = bytearray(mq.get())
+            while len(data) < self.STDOUT_BATCH_SIZE:
+                try:
+                    data += mq.get_nowait()
+                except Empty:
+                    break
+            stdout.write(data)
+            stdout.flush()
 
 
 def main():
@@ -323,16 +598,20 @@ def main():
     atexit.register(enable_echo, True)
     enable_echo(False)
 
-    ThreadingTCPServer.allow_reuse_address = True
-    server = ThreadingTCPServer(("", 1080), Socks5RequestHandler)
+    try:
+        import uvloop
+    except ImportError:
+        pass  # Use the default asyncio event loop
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    server = Socks5Server(("", 1080), Socks5RequestHandler)
     server.session_manager = ClipsSessionManager(server)
     try:
         sys.stderr.write("SOCKS server listening on port 1080 ...\n")
         sys.stderr.flush()
-        server.serve_forever()
+        asyncio.run(server.serve_forever())
     except KeyboardInterrupt:
-        server.server_close()
-        server.shutdown()
         server.session_manager.stop()
 
 